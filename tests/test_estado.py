@@ -0,0 +1,145 @@
+import asyncio
+import types
+
+import pytest
+from cachetools import TTLCache
+from azure.cosmos import exceptions as cosmos_exceptions
+
+import app
+
+
+class ContenedorFalso:
+    # Imita las operaciones de UserStates que usa el bot, con etags y escrituras condicionales
+    def __init__(self):
+        self.docs = {}
+        self.version = 0
+        self.fallos = []
+
+    def _guardar(self, document: dict) -> dict:
+        self.version += 1
+        guardado = dict(document, _etag=f"e{self.version}")
+        self.docs[document["id"]] = guardado
+        return dict(guardado)
+
+    def escritura_externa(self, user_id: str, state: dict):
+        # Otra instancia del bot escribe el documento
+        self._guardar({"id": user_id, "user_id": user_id, "state": state})
+
+    def estado(self, user_id: str) -> dict:
+        return self.docs[user_id]["state"]
+
+    async def read_item(self, item, partition_key, **kwargs):
+        await asyncio.sleep(0)
+        if item not in self.docs:
+            raise cosmos_exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+        return dict(self.docs[item])
+
+    async def create_item(self, document):
+        await asyncio.sleep(0)
+        if self.fallos:
+            raise self.fallos.pop(0)
+        if document["id"] in self.docs:
+            raise cosmos_exceptions.CosmosResourceExistsError(status_code=409, message="conflict")
+        return self._guardar(document)
+
+    async def replace_item(self, item, document, etag=None, match_condition=None):
+        await asyncio.sleep(0)
+        if self.fallos:
+            raise self.fallos.pop(0)
+        if item not in self.docs:
+            raise cosmos_exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+        if self.docs[item]["_etag"] != etag:
+            raise cosmos_exceptions.CosmosAccessConditionFailedError(status_code=412, message="precondition")
+        return self._guardar(document)
+
+
+class Reloj:
+    def __init__(self):
+        self.ahora = 0.0
+
+    def __call__(self):
+        return self.ahora
+
+
+@pytest.fixture
+def contenedor():
+    return ContenedorFalso()
+
+
+@pytest.fixture
+def reloj():
+    return Reloj()
+
+
+@pytest.fixture
+def bot(contenedor, reloj, monkeypatch):
+    monkeypatch.setattr(app, "ESTADO_ESPERA_REINTENTO", 0)
+    services = types.SimpleNamespace(cosmos_available=True, user_state_container=contenedor)
+    bot = app.SmartBuddyBot(services)
+    bot._state_cache = TTLCache(maxsize=100, ttl=60, timer=reloj)
+    return bot
+
+
+PENDIENTE = {"id": "ia_1", "nombre": "Charla", "sala": "ia", "hora": "10:00"}
+
+
+def test_cambio_tras_caducar_la_cache_borra_las_claves_quitadas(bot, contenedor, reloj):
+    contenedor.escritura_externa("u", {"intereses": ["ia"], "estado": "listo", "eventos_pendientes": [PENDIENTE]})
+
+    async def turno():
+        await bot.get_user_state("u")
+        reloj.ahora = 59.5
+        user_state = await bot.get_user_state("u")
+        # La reserva en Graph tarda: la entrada de la caché caduca antes de guardar
+        reloj.ahora = 60.5
+        user_state.pop("eventos_pendientes", None)
+        assert await bot.save_user_state_bg("u", user_state)
+        return await bot.get_user_state("u")
+
+    siguiente = asyncio.run(turno())
+    assert "eventos_pendientes" not in contenedor.estado("u")
+    assert "eventos_pendientes" not in siguiente
+
+
+def test_conflicto_412_relee_y_reaplica_los_cambios(bot, contenedor):
+    contenedor.escritura_externa("u", {"intereses": ["ia"], "estado": "listo", "eventos_pendientes": [PENDIENTE]})
+
+    async def turno():
+        user_state = await bot.get_user_state("u")
+        # Otra instancia cambia los intereses mientras este turno está en curso
+        contenedor.escritura_externa(
+            "u", {"intereses": ["cloud"], "estado": "listo", "eventos_pendientes": [PENDIENTE]}
+        )
+        user_state.pop("eventos_pendientes", None)
+        assert await bot.save_user_state_bg("u", user_state)
+        return await bot.get_user_state("u")
+
+    siguiente = asyncio.run(turno())
+    assert contenedor.estado("u") == {"intereses": ["cloud"], "estado": "listo"}
+    assert siguiente == {"intereses": ["cloud"], "estado": "listo"}
+
+
+def test_creacion_concurrente_409_reaplica_sobre_el_documento_creado(bot, contenedor):
+    async def turno():
+        user_state = await bot.get_user_state("nuevo")
+        contenedor.escritura_externa("nuevo", {"estado": "esperando_intereses", "otro": 1})
+        assert await bot.save_user_state_bg("nuevo", {"estado": "listo", "intereses": ["ia"]}, user_state.inicial)
+
+    asyncio.run(turno())
+    assert contenedor.estado("nuevo") == {"estado": "listo", "intereses": ["ia"], "otro": 1}
+
+
+def test_errores_persistentes_descartan_el_cambio_y_no_lo_confirman(bot, contenedor):
+    contenedor.escritura_externa("u", {"estado": "listo", "intereses": ["ia"]})
+    contenedor.fallos = [
+        cosmos_exceptions.CosmosHttpResponseError(status_code=503, message="unavailable")
+    ] * app.ESTADO_MAX_INTENTOS
+
+    async def turno():
+        user_state = await bot.get_user_state("u")
+        user_state["estado"] = "esperando_intereses"
+        return await bot.save_user_state_bg("u", user_state)
+
+    assert asyncio.run(turno()) is False
+    assert contenedor.estado("u") == {"estado": "listo", "intereses": ["ia"]}
+    assert "u" not in bot._state_cache
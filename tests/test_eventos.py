@@ -0,0 +1,44 @@
+import asyncio
+import types
+
+from azure.cosmos import exceptions as cosmos_exceptions
+
+import app
+
+EVENTOS = [
+    {"id": "ia_1", "nombre": "A", "sala": "1", "hora": "10:00", "popularidad": 50, "temas": ["ia"]},
+    {"id": "ia_2", "nombre": "B", "sala": "1", "hora": "09:00", "popularidad": 90, "temas": ["ia"]},
+    {"id": "cloud_1", "nombre": "C", "sala": "2", "hora": "11:00", "popularidad": 90, "temas": ["cloud", "ia"]},
+    {"id": "mk_1", "nombre": "D", "sala": "3", "hora": "08:00", "popularidad": 99, "temas": ["marketing"]},
+    {"id": "ia_3", "nombre": "E", "sala": "1", "hora": "12:00", "popularidad": 10, "temas": ["ia"]},
+]
+
+
+class EventosSinIndice:
+    # Contenedor creado antes de la política de indexación: rechaza el ORDER BY como Cosmos
+    def __init__(self):
+        self.consultas = []
+
+    async def query_items(self, query, parameters, **kwargs):
+        self.consultas.append(query)
+        if "ORDER BY" in query:
+            raise cosmos_exceptions.CosmosHttpResponseError(
+                status_code=400,
+                message="The order by query does not have a corresponding composite index that it can be served from.",
+            )
+        intereses = parameters[0]["value"]
+        for evento in EVENTOS:
+            await asyncio.sleep(0)
+            if any(t in intereses for t in evento["temas"]):
+                yield evento
+
+
+def test_sin_indice_compuesto_ordena_en_memoria_y_no_reintenta_el_order_by():
+    contenedor = EventosSinIndice()
+    bot = app.SmartBuddyBot(types.SimpleNamespace(event_container=contenedor))
+
+    eventos = asyncio.run(bot.buscar_eventos(["ia"]))
+    assert [e["id"] for e in eventos] == ["ia_2", "cloud_1", "ia_1"]
+
+    asyncio.run(bot.buscar_eventos(["cloud"]))
+    assert contenedor.consultas == [app.QUERY_TOP_EVENTOS, app.QUERY_EVENTOS_INTERESES, app.QUERY_EVENTOS_INTERESES]
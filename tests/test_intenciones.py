@@ -0,0 +1,38 @@
+import pytest
+
+import app
+
+
+def intencion(texto: str):
+    m = app.INTENCION_RE.search(texto.strip().lower())
+    return m.lastgroup if m else None
+
+
+@pytest.mark.parametrize("texto", [
+    "¿Qué me recomiendas?",
+    "me recomiendas algo",
+    "recomiendas eventos?",
+    "no me recomiendas nada",
+    "quiero que me recomiendes algo",
+    "puedes recomendar algo",
+    "Recomiéndame algo",
+    "recomiendame",
+    "una recomendación",
+])
+def test_peticiones_de_recomendacion(texto):
+    assert intencion(texto) == "recomendar_eventos"
+
+
+@pytest.mark.parametrize("texto", ["recomiendale algo a Ana", "recomiéndale esto", "recomendale"])
+def test_recomendar_a_otra_persona_no_cuenta(texto):
+    assert intencion(texto) is None
+
+
+@pytest.mark.parametrize("texto, esperada", [
+    ("sí", "agendar_evento"),
+    ("no", "descartar_eventos"),
+    ("mis intereses", "mostrar_intereses"),
+    ("quiero cambiar intereses", "cambiar_intereses"),
+])
+def test_otras_intenciones(texto, esperada):
+    assert intencion(texto) == esperada